@@ -0,0 +1,76 @@
+import argparse
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from client import API_BASE_URL, AsyncSegmentClient, SegmentClient
+
+
+# Сравнение клиента с прежним способом обращения к API (отдельный requests.get
+# на каждую проверку, как в streamlit_app.py). Сервис должен быть запущен.
+
+def timed(name, lookups, fn):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"{name:<40} {elapsed:8.3f} s  {lookups / elapsed:10.0f} lookups/s")
+
+
+# Прежний способ: новое соединение и запрос на каждую проверку
+def bare_requests(base_url, checks):
+    for user_id, segment in checks:
+        requests.get(f"{base_url}/users/{user_id}/segments/{segment}").json()
+
+
+def bare_requests_threads(base_url, checks, threads):
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(
+            lambda check: requests.get(f"{base_url}/users/{check[0]}/segments/{check[1]}").json(),
+            checks
+        ))
+
+
+def client_threads(client, checks, threads):
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(lambda check: client.is_member(*check), checks))
+
+
+async def async_client(base_url, checks):
+    async with AsyncSegmentClient(base_url) as client:
+        await asyncio.gather(*(client.is_member(user_id, segment) for user_id, segment in checks))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark SegmentClient against bare requests")
+    parser.add_argument('--base-url', default=API_BASE_URL)
+    parser.add_argument('--lookups', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=16)
+    args = parser.parse_args()
+
+    users = [user['id'] for user in requests.get(f"{args.base_url}/users/").json()]
+    segments = [segment['segment'] for segment in requests.get(f"{args.base_url}/segments/").json()]
+    checks = [(random.choice(users), random.choice(segments)) for _ in range(args.lookups)]
+
+    timed("requests.get per call", len(checks), lambda: bare_requests(args.base_url, checks))
+    timed(f"requests.get per call, {args.threads} threads", len(checks),
+          lambda: bare_requests_threads(args.base_url, checks, args.threads))
+
+    with SegmentClient(args.base_url, cache_ttl=0) as client:
+        timed("SegmentClient, no cache", len(checks),
+              lambda: [client.is_member(*check) for check in checks])
+    with SegmentClient(args.base_url, cache_ttl=0) as client:
+        timed(f"SegmentClient batched, {args.threads} threads", len(checks),
+              lambda: client_threads(client, checks, args.threads))
+    with SegmentClient(args.base_url) as client:
+        timed("SegmentClient, cold cache", len(checks),
+              lambda: [client.is_member(*check) for check in checks])
+        timed("SegmentClient, warm cache", len(checks),
+              lambda: [client.is_member(*check) for check in checks])
+    timed("AsyncSegmentClient, gather", len(checks), lambda: asyncio.run(async_client(args.base_url, checks)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,376 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future
+
+import requests
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+API_BASE_URL = "http://127.0.0.1:8000"
+
+
+# Склейка одиночных запросов сегментов пользователей в пакетные.
+# Если к серверу ничего не отправляется, запрос уходит сразу. Пока пакет
+# в пути, новые id копятся. Отправивший пакет поток возвращается со своим
+# результатом, а роль отправителя переходит к одному из ждущих: он заберёт
+# свой id и накопленные до max_batch штук.
+# window > 0 дополнительно задерживает каждый пакет, чтобы собрать больше id.
+class _UserSegmentsBatcher:
+    def __init__(self, fetch, window, max_batch):
+        self._fetch = fetch
+        self._window = window
+        self._max_batch = max_batch
+        self._pending = {}      # user_id -> Future
+        self._lock = threading.Lock()
+        self._sender_done = threading.Condition(self._lock)
+        self._sending = False
+
+    def get(self, user_id):
+        with self._lock:
+            future = self._pending.get(user_id)
+            if future is None:
+                future = Future()
+                self._pending[user_id] = future
+            # Пока пакет в пути, ждём; после него либо результат готов,
+            # либо наш id ещё в очереди и мы отправляем следующий пакет
+            while self._sending and not future.done():
+                self._sender_done.wait()
+            if future.done():
+                return future.result()
+            self._sending = True
+
+        try:
+            if self._window > 0:
+                time.sleep(self._window)
+            self._send(self._take(user_id))
+        finally:
+            with self._lock:
+                self._sending = False
+                self._sender_done.notify_all()
+        return future.result()
+
+    # Свой id первым, затем самые старые из очереди
+    def _take(self, user_id):
+        with self._lock:
+            user_ids = [user_id] + [other for other in self._pending if other != user_id]
+            return {other: self._pending.pop(other) for other in user_ids[:self._max_batch]}
+
+    def _send(self, batch):
+        if not batch:
+            return
+        try:
+            result = self._fetch(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                future.set_exception(e)
+            return
+        for user_id, future in batch.items():
+            future.set_result(result.get(user_id, []))
+
+
+# Клиент Segment Management API.
+# Использует пул keep-alive соединений с повторами, склеивает одиночные
+# запросы сегментов пользователей в пакеты и кэширует их на cache_ttl секунд.
+class SegmentClient:
+    def __init__(self, base_url=API_BASE_URL, timeout=5.0, pool_size=10, retries=3,
+                 cache_ttl=5.0, cache_size=10000, batch_window=0.0, max_batch=500):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.max_batch = max_batch
+
+        # Повторы только для идемпотентных методов
+        self._session = self._make_session(
+            pool_size, retries, ('GET', 'PUT', 'DELETE', 'HEAD', 'OPTIONS')
+        )
+        # Пакетное чтение сегментов идёт через POST, но ничего не меняет –
+        # для него отдельный пул, где повторяется и POST
+        self._read_session = self._make_session(pool_size, retries, ('POST',))
+
+        # cache_ttl=0 отключает кэш
+        self._cache = TTLCache(maxsize=cache_size, ttl=cache_ttl) if cache_ttl > 0 else None
+        self._cache_lock = threading.Lock()
+        self._batcher = _UserSegmentsBatcher(self._fetch_users_segments, batch_window, max_batch)
+
+    @staticmethod
+    def _make_session(pool_size, retries, methods):
+        session = requests.Session()
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.1,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=methods,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def close(self):
+        self._session.close()
+        self._read_session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _request(self, method, path, session=None, **kwargs):
+        session = session or self._session
+        response = session.request(method, f"{self.base_url}{path}", timeout=self.timeout, **kwargs)
+        response.raise_for_status()
+        return response.json()
+
+    # Сброс кэша: одного пользователя или целиком (после изменения сегментов)
+    def invalidate(self, user_id=None):
+        if self._cache is None:
+            return
+        with self._cache_lock:
+            if user_id is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(user_id, None)
+
+    def _fetch_users_segments(self, user_ids):
+        data = self._request(
+            'POST', '/users/segments/batch', session=self._read_session, json={"user_ids": user_ids}
+        )
+        result = {int(user_id): segments for user_id, segments in data.items()}
+        if self._cache is not None:
+            with self._cache_lock:
+                self._cache.update(result)
+        return result
+
+    def _cached_segments(self, user_id):
+        if self._cache is None:
+            return None
+        with self._cache_lock:
+            return self._cache.get(user_id)
+
+    # Сегменты пользователя (пустой список, если их нет)
+    def get_user_segments(self, user_id):
+        segments = self._cached_segments(user_id)
+        if segments is not None:
+            return segments
+        return self._batcher.get(user_id)
+
+    # Сегменты нескольких пользователей: {user_id: [segment, ...]}
+    def get_users_segments(self, user_ids):
+        result = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            segments = self._cached_segments(user_id)
+            if segments is None:
+                missing.append(user_id)
+            else:
+                result[user_id] = segments
+        for start in range(0, len(missing), self.max_batch):
+            chunk = missing[start:start + self.max_batch]
+            fetched = self._fetch_users_segments(chunk)
+            result.update({user_id: fetched.get(user_id, []) for user_id in chunk})
+        return result
+
+    # Состоит ли пользователь в сегменте
+    def is_member(self, user_id, segment):
+        return segment in self.get_user_segments(user_id)
+
+    def get_users(self):
+        return self._request('GET', '/users/')
+
+    def create_user(self, name, email=None):
+        return self._request('POST', '/users/', json={"name": name, "email": email})
+
+    def add_user_to_segment(self, user_id, segment):
+        result = self._request('POST', f'/users/{user_id}/segments/{segment}')
+        self.invalidate(user_id)
+        return result
+
+    def remove_user_from_segment(self, user_id, segment):
+        result = self._request('DELETE', f'/users/{user_id}/segments/{segment}')
+        self.invalidate(user_id)
+        return result
+
+    def get_segments(self):
+        return self._request('GET', '/segments/')
+
+    def get_segment(self, segment):
+        return self._request('GET', f'/segments/{segment}')
+
+    def create_segment(self, segment, description=None):
+        return self._request('POST', '/segments/', json={"segment": segment, "description": description})
+
+    def delete_segment(self, segment):
+        result = self._request('DELETE', f'/segments/{segment}')
+        self.invalidate()
+        return result
+
+    def update_segment_description(self, segment, new_description):
+        return self._request(
+            'PUT', f'/segments/{segment}/description', params={"new_description": new_description}
+        )
+
+    def distribute_segment(self, segment, percent):
+        result = self._request('POST', f'/segments/{segment}/distribute', json={"percent": percent})
+        self.invalidate()
+        return result
+
+    # arms – {segment: percent}
+    def split_segments(self, arms, stratify_by=None):
+        result = self._request('POST', '/segments/split', json={
+            "arms": [{"segment": segment, "percent": percent} for segment, percent in arms.items()],
+            "stratify_by": stratify_by,
+        })
+        self.invalidate()
+        return result
+
+    def move_users(self, from_segment, to_segment):
+        result = self._request(
+            'POST', '/segments/move_users', json={"from_segment": from_segment, "to_segment": to_segment}
+        )
+        self.invalidate()
+        return result
+
+    def get_distribution_info(self, segment):
+        return self._request('GET', f'/segments/{segment}/distribute')
+
+    def get_segment_users(self, segment):
+        return self._request('GET', f'/segments/{segment}/users')['users']
+
+    def get_segments_stats(self):
+        return self._request('GET', '/segments/stats')
+
+    def get_segments_overlap(self):
+        return self._request('GET', '/segments/overlap')
+
+    def compact_storage(self, convert=False):
+        return self._request('POST', '/maintenance/compact', params={"convert": convert})
+
+
+# Асинхронный вариант клиента для asyncio.
+# HTTP-вызовы выполняются в пуле потоков поверх SegmentClient (общие пул
+# соединений и кэш), а склейка запросов идёт в цикле событий: корутины,
+# запрошенные до отправки или пока пакет в пути, уходят следующим пакетом.
+class AsyncSegmentClient:
+    def __init__(self, base_url=API_BASE_URL, batch_window=0.0, max_batch=500, **kwargs):
+        self._client = SegmentClient(base_url, batch_window=batch_window, max_batch=max_batch, **kwargs)
+        self._batch_window = batch_window
+        self._max_batch = max_batch
+        self._pending = {}      # user_id -> asyncio.Future
+        self._drain_task = None
+
+    async def close(self):
+        await asyncio.to_thread(self._client.close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def invalidate(self, user_id=None):
+        self._client.invalidate(user_id)
+
+    async def get_user_segments(self, user_id):
+        segments = self._client._cached_segments(user_id)
+        if segments is not None:
+            return segments
+
+        future = self._pending.get(user_id)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[user_id] = future
+            if self._drain_task is None:
+                self._drain_task = asyncio.create_task(self._drain())
+        return await asyncio.shield(future)
+
+    # Отправка накопленных пакетов, пока они не закончатся
+    async def _drain(self):
+        if self._batch_window > 0:
+            await asyncio.sleep(self._batch_window)
+        else:
+            # Даём уже запущенным корутинам добавить свои id в первый пакет
+            await asyncio.sleep(0)
+        while True:
+            batch = self._take()
+            if not batch:
+                self._drain_task = None
+                return
+            await self._send(batch)
+
+    def _take(self):
+        user_ids = list(self._pending)[:self._max_batch]
+        return {user_id: self._pending.pop(user_id) for user_id in user_ids}
+
+    async def _send(self, batch):
+        if not batch:
+            return
+        try:
+            result = await asyncio.to_thread(self._client._fetch_users_segments, list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for user_id, future in batch.items():
+            if not future.done():
+                future.set_result(result.get(user_id, []))
+
+    async def get_users_segments(self, user_ids):
+        return await asyncio.to_thread(self._client.get_users_segments, user_ids)
+
+    async def is_member(self, user_id, segment):
+        return segment in await self.get_user_segments(user_id)
+
+    async def get_users(self):
+        return await asyncio.to_thread(self._client.get_users)
+
+    async def create_user(self, name, email=None):
+        return await asyncio.to_thread(self._client.create_user, name, email)
+
+    async def add_user_to_segment(self, user_id, segment):
+        return await asyncio.to_thread(self._client.add_user_to_segment, user_id, segment)
+
+    async def remove_user_from_segment(self, user_id, segment):
+        return await asyncio.to_thread(self._client.remove_user_from_segment, user_id, segment)
+
+    async def get_segments(self):
+        return await asyncio.to_thread(self._client.get_segments)
+
+    async def get_segment(self, segment):
+        return await asyncio.to_thread(self._client.get_segment, segment)
+
+    async def create_segment(self, segment, description=None):
+        return await asyncio.to_thread(self._client.create_segment, segment, description)
+
+    async def delete_segment(self, segment):
+        return await asyncio.to_thread(self._client.delete_segment, segment)
+
+    async def update_segment_description(self, segment, new_description):
+        return await asyncio.to_thread(self._client.update_segment_description, segment, new_description)
+
+    async def distribute_segment(self, segment, percent):
+        return await asyncio.to_thread(self._client.distribute_segment, segment, percent)
+
+    async def split_segments(self, arms, stratify_by=None):
+        return await asyncio.to_thread(self._client.split_segments, arms, stratify_by)
+
+    async def move_users(self, from_segment, to_segment):
+        return await asyncio.to_thread(self._client.move_users, from_segment, to_segment)
+
+    async def get_distribution_info(self, segment):
+        return await asyncio.to_thread(self._client.get_distribution_info, segment)
+
+    async def get_segment_users(self, segment):
+        return await asyncio.to_thread(self._client.get_segment_users, segment)
+
+    async def get_segments_stats(self):
+        return await asyncio.to_thread(self._client.get_segments_stats)
+
+    async def get_segments_overlap(self):
+        return await asyncio.to_thread(self._client.get_segments_overlap)
+
+    async def compact_storage(self, convert=False):
+        return await asyncio.to_thread(self._client.compact_storage, convert)
@@ -1,13 +1,23 @@
 import sqlite3
 from contextlib import contextmanager
+from itertools import chain
+
+import numpy as np
+
+from overlap import overlap_matrix
+from split import split_stream
 
 
 DATABASE = 'database.db'
+# Сколько связей удаляется за одну транзакцию
+DELETE_CHUNK_SIZE = 10000
 
 @contextmanager
 def get_db_connection():
     connection = sqlite3.connect(DATABASE)
     connection.row_factory = sqlite3.Row
+    # Без этого SQLite игнорирует ON DELETE CASCADE в U_S
+    connection.execute('PRAGMA foreign_keys = ON')
     try:
         yield connection
     finally:
@@ -16,6 +26,9 @@ def get_db_connection():
 def init_db():
     with get_db_connection() as connection:
         cursor = connection.cursor()
+        # Освобождённые страницы можно вернуть через PRAGMA incremental_vacuum
+        # (действует только для новой БД, существующую переводит compact_storage)
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
         # Users DB
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS Users (
@@ -42,6 +55,24 @@ def init_db():
             PRIMARY KEY (user_id, segment_id)
         )
         ''')
+        # Индекс для выборок по сегменту и каскадного удаления сегментов
+        cursor.execute(
+            'CREATE INDEX IF NOT EXISTS idx_u_s_segment ON U_S (segment_id, user_id)'
+        )
+        # Версия связей: функции записи ниже увеличивают её один раз за транзакцию,
+        # изменяющую U_S или Segments, в том числе из других процессов.
+        # По ней сбрасывается кэш матрицы пересечений
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS Membership_Version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+        ''')
+        cursor.execute('INSERT OR IGNORE INTO Membership_Version (id, version) VALUES (1, 0)')
+        # Построчные триггеры прежних версий замедляли массовую запись
+        for name in ('u_s_insert_version', 'u_s_delete_version', 'u_s_update_version',
+                     'segments_insert_version', 'segments_delete_version', 'segments_update_version'):
+            cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
         # Изначальные значения, который будут в таблицах. Их можно не вносить вовсе
         cursor.executemany(
             'INSERT OR IGNORE INTO Segments (segment, description) VALUES (?, ?)',
@@ -65,6 +96,10 @@ def init_db():
 
         connection.commit()
 
+# Увеличение версии связей в текущей транзакции (до commit)
+def _bump_membership_version(connection):
+    connection.execute('UPDATE Membership_Version SET version = version + 1 WHERE id = 1')
+
 # Добавление пользователя
 def add_user(name: str, email: str = None):
     with get_db_connection() as connection:
@@ -79,10 +114,21 @@ def add_user(name: str, email: str = None):
 def add_user_to_segment(user_id, segment_id):
     with get_db_connection() as connection:
         cursor = connection.cursor()
+        # Связь с несуществующим пользователем или сегментом не создаётся
         cursor.execute(
-            'INSERT OR IGNORE INTO U_S (user_id, segment_id) VALUES (?, ?)', (user_id, segment_id)
+            '''
+            INSERT OR IGNORE INTO U_S (user_id, segment_id)
+            SELECT Users.id, Segments.id FROM Users, Segments
+            WHERE Users.id = ? AND Segments.id = ?
+            ''',
+            (user_id, segment_id)
         )
+        # True, если связь действительно добавлена
+        added = cursor.rowcount > 0
+        if added:
+            _bump_membership_version(connection)
         connection.commit()
+        return added
 
 # Удаление пользователя из сегмента
 def delete_user_in_segment(user_id, segment_id):
@@ -91,6 +137,8 @@ def delete_user_in_segment(user_id, segment_id):
         cursor.execute(
             'DELETE FROM U_S WHERE user_id = ? AND segment_id = ?', (user_id, segment_id)
         )
+        if cursor.rowcount:
+            _bump_membership_version(connection)
         connection.commit()
 
 # Добавление сегмента
@@ -100,15 +148,37 @@ def add_segment(segment, description):
         cursor.execute(
             'INSERT OR IGNORE INTO Segments (segment, description) VALUES (?, ?)', (segment, description)
         )
+        if cursor.rowcount:
+            _bump_membership_version(connection)
         connection.commit()
 
-# Удаление сегмента
+# Удаление связей сегмента порциями, чтобы не держать одну огромную транзакцию
+def _delete_segment_links(connection, segment_id):
+    cursor = connection.cursor()
+    removed = 0
+    while True:
+        cursor.execute(
+            'DELETE FROM U_S WHERE rowid IN (SELECT rowid FROM U_S WHERE segment_id = ? LIMIT ?)',
+            (segment_id, DELETE_CHUNK_SIZE)
+        )
+        _bump_membership_version(connection)
+        connection.commit()
+        removed += cursor.rowcount
+        if cursor.rowcount < DELETE_CHUNK_SIZE:
+            return removed
+
+# Удаление сегмента вместе со связями
 def delete_segment(segment):
     with get_db_connection() as connection:
         cursor = connection.cursor()
-        cursor.execute(
-            'DELETE FROM Segments WHERE segment = ?', (segment,)
-        )
+        cursor.execute('SELECT id FROM Segments WHERE segment = ?', (segment,))
+        row = cursor.fetchone()
+        if row is None:
+            return
+        _delete_segment_links(connection, row['id'])
+        # Связи, добавленные во время удаления, уберёт каскад
+        cursor.execute('DELETE FROM Segments WHERE id = ?', (row['id'],))
+        _bump_membership_version(connection)
         connection.commit()
 
 # Распределение сегмента на N% пользователей
@@ -125,8 +195,8 @@ def distribute_segment_to_percent(segment_id, percent):
         cursor.execute('SELECT COUNT(*) as count FROM Users')
         total_users = cursor.fetchone()['count']
 
-        # Вычисляем количество пользователей для выборки
-        sample_size = int(total_users * percent / 100)
+        # Вычисляем количество пользователей для выборки (от 0 до всех пользователей)
+        sample_size = min(max(int(total_users * percent / 100), 0), total_users)
 
         # Выбираем случайных пользователей
         cursor.execute(
@@ -139,6 +209,7 @@ def distribute_segment_to_percent(segment_id, percent):
                 (user['id'], segment_id)
             )
 
+        _bump_membership_version(connection)
         connection.commit()
 
 # Получение сегментов пользователя
@@ -150,6 +221,30 @@ def get_user_segments(user_id):
         )
         return [row['segment'] for row in cursor.fetchall()]
 
+# Получение сегментов сразу для нескольких пользователей
+def get_users_segments(user_ids):
+    result = {user_id: [] for user_id in user_ids}
+    ids = list(result)
+    with get_db_connection() as connection:
+        cursor = connection.cursor()
+        # Порции не превышают лимит параметров SQLite
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ', '.join('?' * len(chunk))
+            cursor.execute(
+                f'''
+                SELECT U_S.user_id, Segments.segment
+                FROM U_S
+                JOIN Segments ON Segments.id = U_S.segment_id
+                WHERE U_S.user_id IN ({placeholders})
+                ORDER BY U_S.user_id, U_S.segment_id
+                ''',
+                chunk
+            )
+            for row in cursor.fetchall():
+                result[row['user_id']].append(row['segment'])
+    return result
+
 # Получение пользователей в сегменте
 def get_users_in_segment(segment):
     with get_db_connection() as connection:
@@ -161,6 +256,7 @@ def get_users_in_segment(segment):
             JOIN U_S ON Users.id = U_S.user_id
             JOIN Segments ON U_S.segment_id = Segments.id
             WHERE Segments.segment = ?
+            ORDER BY U_S.user_id
             ''',
             (segment,)
         )
@@ -223,7 +319,218 @@ def move_users_between_segments(from_segment_name, to_segment_name):
                 (user_id, to_segment_id)
             )
 
+        _bump_membership_version(connection)
+        connection.commit()
+
+# Получение списка всех пользователей
+def get_all_users():
+    with get_db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('SELECT id, name, email FROM Users')
+        return [dict(row) for row in cursor.fetchall()]
+
+# Получение списка всех сегментов
+def get_all_segments():
+    with get_db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('SELECT segment, description FROM Segments')
+        return [dict(row) for row in cursor.fetchall()]
+
+# Получение информации о сегменте (None, если сегмента нет)
+def get_segment(segment):
+    with get_db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            'SELECT segment, description FROM Segments WHERE segment = ?', (segment,)
+        )
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+# Получение ID сегмента по названию (None, если сегмента нет)
+def get_segment_id(segment):
+    with get_db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('SELECT id FROM Segments WHERE segment = ?', (segment,))
+        row = cursor.fetchone()
+        return row['id'] if row else None
+
+# Проверка, состоит ли пользователь в сегменте
+def is_user_in_segment(user_id, segment_id):
+    with get_db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute(
+            'SELECT 1 FROM U_S WHERE user_id = ? AND segment_id = ?', (user_id, segment_id)
+        )
+        return cursor.fetchone() is not None
+
+# Количество пользователей в сегменте
+def count_users_in_segment(segment_id):
+    with get_db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('SELECT COUNT(*) FROM U_S WHERE segment_id = ?', (segment_id,))
+        return cursor.fetchone()[0]
+
+# Общее количество пользователей
+def count_users():
+    with get_db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('SELECT COUNT(*) FROM Users')
+        return cursor.fetchone()[0]
+
+# Текущая версия связей пользователей и сегментов
+def get_membership_version():
+    with get_db_connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute('SELECT version FROM Membership_Version WHERE id = 1')
+        return cursor.fetchone()[0]
+
+# Матрица пересечений сегментов за один проход по U_S
+def get_segments_overlap():
+    with get_db_connection() as connection:
+        connection.row_factory = None
+        cursor = connection.cursor()
+        cursor.execute('SELECT id, segment FROM Segments ORDER BY segment')
+        segments = cursor.fetchall()
+
+        cursor.execute('SELECT user_id, segment_id FROM U_S ORDER BY user_id, segment_id')
+        pairs = np.fromiter(chain.from_iterable(cursor), dtype=np.int64).reshape(-1, 2)
+
+    # Номер столбца для каждого id сегмента, -1 – сегмента нет
+    max_id = max((segment_id for segment_id, _ in segments), default=0)
+    lookup = np.full(max_id + 1, -1, dtype=np.int64)
+    for column, (segment_id, _) in enumerate(segments):
+        lookup[segment_id] = column
+
+    segment_ids = pairs[:, 1]
+    known = (segment_ids >= 0) & (segment_ids <= max_id)
+    pairs = pairs[known]
+    columns = lookup[pairs[:, 1]]
+    known = columns >= 0
+
+    matrix = overlap_matrix(pairs[known, 0], columns[known], len(segments))
+    return {
+        'segments': [name for _, name in segments],
+        'matrix': matrix.tolist()
+    }
+
+# Взаимоисключающее распределение нескольких сегментов (рукавов A/B/C-теста)
+# за один проход по Users. При stratify_segment_id доли соблюдаются отдельно
+# для участников и неучастников этого сегмента.
+def split_segments(segment_ids, percents, stratify_segment_id=None):
+    with get_db_connection() as connection:
+        connection.row_factory = None
+        cursor = connection.cursor()
+
+        # Очищаем рукава; дальнейшие чтения идут в той же транзакции
+        cursor.executemany(
+            'DELETE FROM U_S WHERE segment_id = ?',
+            [(segment_id,) for segment_id in segment_ids]
+        )
+
+        if stratify_segment_id is None:
+            cursor.execute('SELECT COUNT(*) FROM Users')
+            strata_sizes = {False: cursor.fetchone()[0]}
+            cursor.execute('SELECT id, 0 FROM Users')
+        else:
+            cursor.execute(
+                '''
+                SELECT COUNT(*), COUNT(U_S.user_id)
+                FROM Users
+                LEFT JOIN U_S ON U_S.user_id = Users.id AND U_S.segment_id = ?
+                ''',
+                (stratify_segment_id,)
+            )
+            total, members = cursor.fetchone()
+            strata_sizes = {False: total - members, True: members}
+            cursor.execute(
+                '''
+                SELECT Users.id, U_S.user_id IS NOT NULL
+                FROM Users
+                LEFT JOIN U_S ON U_S.user_id = Users.id AND U_S.segment_id = ?
+                ''',
+                (stratify_segment_id,)
+            )
+
+        arms = split_stream(
+            ((user_id, bool(stratum)) for user_id, stratum in cursor),
+            strata_sizes,
+            percents
+        )
+
+        # Массовая вставка всех рукавов
+        for segment_id, user_ids in zip(segment_ids, arms):
+            cursor.executemany(
+                'INSERT OR IGNORE INTO U_S (user_id, segment_id) VALUES (?, ?)',
+                ((user_id, segment_id) for user_id in user_ids)
+            )
+
+        _bump_membership_version(connection)
         connection.commit()
+        return [len(user_ids) for user_ids in arms]
+
+# Размер файла БД в байтах
+def _database_size(cursor):
+    cursor.execute('PRAGMA page_count')
+    page_count = cursor.fetchone()[0]
+    cursor.execute('PRAGMA page_size')
+    return page_count * cursor.fetchone()[0]
+
+# Удаление связей без пользователя или сегмента, обновление статистики
+# планировщика и возврат освободившегося места.
+# convert=True переводит старую БД (auto_vacuum = NONE) в режим incremental
+# полным VACUUM, который блокирует БД на время перезаписи
+def compact_storage(convert=False):
+    with get_db_connection() as connection:
+        connection.row_factory = None
+        cursor = connection.cursor()
+
+        # Связи удалённых сегментов
+        cursor.execute(
+            'SELECT DISTINCT segment_id FROM U_S WHERE segment_id NOT IN (SELECT id FROM Segments)'
+        )
+        orphan_segments = [row[0] for row in cursor.fetchall()]
+        orphans_removed = 0
+        for segment_id in orphan_segments:
+            orphans_removed += _delete_segment_links(connection, segment_id)
+
+        # Связи удалённых пользователей
+        cursor.execute(
+            'SELECT DISTINCT user_id FROM U_S WHERE user_id NOT IN (SELECT id FROM Users)'
+        )
+        orphan_users = [row[0] for row in cursor.fetchall()]
+        for start in range(0, len(orphan_users), DELETE_CHUNK_SIZE):
+            cursor.executemany(
+                'DELETE FROM U_S WHERE user_id = ?',
+                [(user_id,) for user_id in orphan_users[start:start + DELETE_CHUNK_SIZE]]
+            )
+            _bump_membership_version(connection)
+            connection.commit()
+            orphans_removed += cursor.rowcount
+
+        cursor.execute('ANALYZE')
+        connection.commit()
+
+        # Размер замеряется после ANALYZE: sqlite_stat1 может занять новые страницы
+        size_before = _database_size(cursor)
+        cursor.execute('PRAGMA auto_vacuum')
+        if cursor.fetchone()[0] == 2:
+            cursor.execute('PRAGMA incremental_vacuum').fetchall()
+            vacuum = 'incremental'
+        elif convert:
+            cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            cursor.execute('VACUUM')
+            vacuum = 'full'
+        else:
+            vacuum = 'skipped'
+
+        size_after = _database_size(cursor)
+        return {
+            'orphans_removed': orphans_removed,
+            'vacuum': vacuum,
+            'size_before': size_before,
+            'size_after': size_after,
+            'bytes_reclaimed': size_before - size_after
+        }
 
 if __name__ == '__main__':
     init_db()
\ No newline at end of file
@@ -1,9 +1,13 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Response
 from contextlib import asynccontextmanager
 from typing import List, Optional
 from pydantic import BaseModel
+import json
+import os
 import sqlite3
 import database  # Импортируем модуль с функциями БД
+import storage
+from singleflight import SingleFlight
 
 
 # Модели данных для API
@@ -26,12 +30,39 @@ class MoveUsersRequest(BaseModel):
     to_segment: str
 
 
+class UsersSegmentsRequest(BaseModel):
+    user_ids: List[int]
+
+
+class SplitArm(BaseModel):
+    segment: str
+    percent: float
+
+
+class SegmentSplit(BaseModel):
+    arms: List[SplitArm]
+    stratify_by: Optional[str] = None
+
+
+# Хранилище данных: SQLite или in-memory (переменная окружения SEGMENT_STORAGE)
+engine = storage.create_engine()
+
+# Объединение одновременных одинаковых запросов на чтение.
+# SEGMENT_COALESCE_GRACE – сколько секунд после выполнения ещё отдавать тот же ответ.
+# Изменяющие endpoint'ы вызывают reads.clear(), чтобы следующее чтение увидело запись
+reads = SingleFlight(grace=float(os.environ.get('SEGMENT_COALESCE_GRACE', '0')))
+
+# Максимум пользователей в одном пакетном запросе
+MAX_BATCH_SIZE = 1000
+
+
 # Обработчик жизненного цикла сервиса
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Инициализация БД при старте
-    database.init_db()
+    engine.start()
     yield
+    engine.close()
     print("Server shutting down")
 
 
@@ -45,6 +76,16 @@ def get_db():
         yield conn
 
 
+# Выполнить чтение один раз для всех одновременных запросов с тем же ключом
+# и отдать всем один и тот же сериализованный ответ
+def coalesced(key, fn):
+    content = reads.do(
+        key,
+        lambda: json.dumps(fn(), ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    )
+    return Response(content=content, media_type="application/json")
+
+
 # Корневой endpoint
 @app.get("/")
 def read_root():
@@ -55,7 +96,8 @@ def read_root():
 @app.post("/users/", status_code=201)
 def create_user(user: UserCreate):
     try:
-        database.add_user(user.name, user.email)
+        engine.add_user(user.name, user.email)
+        reads.clear()
         return {"message": "User created successfully"}
     except sqlite3.IntegrityError:
         raise HTTPException(status_code=400, detail="User already exists")
@@ -64,16 +106,21 @@ def create_user(user: UserCreate):
 # Получить список всех пользователей
 @app.get("/users/", response_model=List[dict])
 def get_all_users():
-    with database.get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, name, email FROM Users")
-        return [dict(row) for row in cursor.fetchall()]
+    return engine.get_all_users()
+
+
+# Получить сегменты сразу для нескольких пользователей
+@app.post("/users/segments/batch")
+def get_users_segments(request: UsersSegmentsRequest):
+    if len(request.user_ids) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_SIZE} users per request")
+    return engine.get_users_segments(request.user_ids)
 
 
 # Получить сегменты пользователя
 @app.get("/users/{user_id}/segments", response_model=List[str])
 def get_user_segments(user_id: int):
-    segments = database.get_user_segments(user_id)
+    segments = engine.get_user_segments(user_id)
     if not segments:
         raise HTTPException(status_code=404, detail="User not found or has no segments")
     return segments
@@ -83,7 +130,8 @@ def get_user_segments(user_id: int):
 @app.post("/segments/", status_code=201)
 def create_segment(segment: SegmentCreate):
     try:
-        database.add_segment(segment.segment, segment.description)
+        engine.add_segment(segment.segment, segment.description)
+        reads.clear()
         return {"message": "Segment created successfully"}
     except sqlite3.IntegrityError:
         raise HTTPException(status_code=400, detail="Segment already exists")
@@ -92,17 +140,15 @@ def create_segment(segment: SegmentCreate):
 # Получить список всех сегментов
 @app.get("/segments/", response_model=List[dict])
 def get_all_segments():
-    with database.get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT segment, description FROM Segments")
-        return [dict(row) for row in cursor.fetchall()]
+    return engine.get_all_segments()
 
 
 # Удалить сегмент
 @app.delete("/segments/{segment_name}")
 def delete_segment(segment_name: str):
     try:
-        database.delete_segment(segment_name)
+        engine.delete_segment(segment_name)
+        reads.clear()
         return {"message": "Segment deleted successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -112,7 +158,7 @@ def delete_segment(segment_name: str):
 @app.put("/segments/{segment_name}/description")
 def update_segment_description(segment_name: str, new_description: str):
     try:
-        database.update_segment_description(segment_name, new_description)
+        engine.update_segment_description(segment_name, new_description)
         return {"message": "Description updated successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -122,15 +168,17 @@ def update_segment_description(segment_name: str, new_description: str):
 @app.post("/users/{user_id}/segments/{segment_name}")
 def add_user_to_segment(user_id: int, segment_name: str):
     try:
-        with database.get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT id FROM Segments WHERE segment = ?", (segment_name,))
-            segment = cursor.fetchone()
-            if not segment:
-                raise HTTPException(status_code=404, detail="Segment not found")
-
-            database.add_user_to_segment(user_id, segment['id'])
-            return {"message": "User added to segment successfully"}
+        segment_id = engine.get_segment_id(segment_name)
+        if segment_id is None:
+            raise HTTPException(status_code=404, detail="Segment not found")
+
+        added = engine.add_user_to_segment(user_id, segment_id)
+        reads.clear()
+        if not added and not engine.is_user_in_segment(user_id, segment_id):
+            raise HTTPException(status_code=404, detail="User not found")
+        return {"message": "User added to segment successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -139,16 +187,16 @@ def add_user_to_segment(user_id: int, segment_name: str):
 @app.delete("/users/{user_id}/segments/{segment_name}")
 def remove_user_from_segment(user_id: int, segment_name: str):
     try:
-        with database.get_db_connection() as conn:
-            cursor = conn.cursor()
-            # Получаем ID сегмента
-            cursor.execute("SELECT id FROM Segments WHERE segment = ?", (segment_name,))
-            segment = cursor.fetchone()
-            if not segment:
-                raise HTTPException(status_code=404, detail="Segment not found")
-
-            database.delete_user_in_segment(user_id, segment['id'])
-            return {"message": "User removed from segment successfully"}
+        # Получаем ID сегмента
+        segment_id = engine.get_segment_id(segment_name)
+        if segment_id is None:
+            raise HTTPException(status_code=404, detail="Segment not found")
+
+        engine.delete_user_in_segment(user_id, segment_id)
+        reads.clear()
+        return {"message": "User removed from segment successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -157,15 +205,52 @@ def remove_user_from_segment(user_id: int, segment_name: str):
 @app.post("/segments/{segment_name}/distribute")
 def distribute_segment(segment_name: str, distribution: SegmentDistribution):
     try:
-        with database.get_db_connection() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT id FROM Segments WHERE segment = ?", (segment_name,))
-            segment = cursor.fetchone()
-            if not segment:
-                raise HTTPException(status_code=404, detail="Segment not found")
-
-            database.distribute_segment_to_percent(segment['id'], distribution.percent)
-            return {"message": f"Segment distributed to {distribution.percent}% of users"}
+        segment_id = engine.get_segment_id(segment_name)
+        if segment_id is None:
+            raise HTTPException(status_code=404, detail="Segment not found")
+
+        engine.distribute_segment_to_percent(segment_id, distribution.percent)
+        reads.clear()
+        return {"message": f"Segment distributed to {distribution.percent}% of users"}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# Разделить пользователей между несколькими сегментами (A/B/C-тест) без пересечений
+@app.post("/segments/split")
+def split_segments(split: SegmentSplit):
+    if not split.arms:
+        raise HTTPException(status_code=400, detail="At least one arm is required")
+    names = [arm.segment for arm in split.arms]
+    percents = [arm.percent for arm in split.arms]
+    if len(set(names)) != len(names):
+        raise HTTPException(status_code=400, detail="Arms must use different segments")
+    # Допуск на погрешность сложения float (99.4 + 0.4 + 0.2 > 100);
+    # split.arm_quotas округляет рукава вниз, поэтому лишних пользователей не будет
+    if any(percent < 0 for percent in percents) or sum(percents) > 100 + 1e-9:
+        raise HTTPException(status_code=400, detail="Arm percents must be non-negative and sum to at most 100")
+
+    segment_ids = [engine.get_segment_id(name) for name in names]
+    if None in segment_ids:
+        raise HTTPException(status_code=404, detail="Segment not found")
+
+    stratify_segment_id = None
+    if split.stratify_by is not None:
+        if split.stratify_by in names:
+            raise HTTPException(status_code=400, detail="Cannot stratify by one of the arms")
+        stratify_segment_id = engine.get_segment_id(split.stratify_by)
+        if stratify_segment_id is None:
+            raise HTTPException(status_code=404, detail="Stratification segment not found")
+
+    try:
+        counts = engine.split_segments(segment_ids, percents, stratify_segment_id)
+        reads.clear()
+        return {
+            "message": f"Users split between {len(names)} segments",
+            "counts": dict(zip(names, counts))
+        }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -174,7 +259,8 @@ def distribute_segment(segment_name: str, distribution: SegmentDistribution):
 @app.post("/segments/move_users")
 def move_users(request: MoveUsersRequest):
     try:
-        database.move_users_between_segments(request.from_segment, request.to_segment)
+        engine.move_users_between_segments(request.from_segment, request.to_segment)
+        reads.clear()
         return {"message": f"Users moved from {request.from_segment} to {request.to_segment}"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -183,77 +269,78 @@ def move_users(request: MoveUsersRequest):
 # Получить статистику по сегментам
 @app.get("/segments/stats")
 def get_segments_stats():
-    return database.get_segments_stats()
+    return coalesced(("stats",), engine.get_segments_stats)
+
+
+# Получить матрицу пересечений сегментов
+@app.get("/segments/overlap")
+def get_segments_overlap():
+    return engine.get_segments_overlap()
+
+
+# Удалить осиротевшие связи и сжать БД
+# convert=true – однократно перевести старую БД в режим incremental vacuum (полный VACUUM)
+@app.post("/maintenance/compact")
+def compact_storage(convert: bool = False):
+    try:
+        report = engine.compact_storage(convert)
+        reads.clear()
+        return report
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
 
 # Получить пользователей в сегменте
 @app.get("/segments/{segment_name}/users")
 def get_segment_users(segment_name: str):
-    users = database.get_users_in_segment(segment_name)
-    if not users:
-        raise HTTPException(status_code=404, detail="Segment not found or has no users")
-    return {"users": users}
+    def read():
+        users = engine.get_users_in_segment(segment_name)
+        if not users:
+            raise HTTPException(status_code=404, detail="Segment not found or has no users")
+        return {"users": users}
+
+    return coalesced(("users", segment_name), read)
 
 
 # Получить информацию о сегменте
 @app.get("/segments/{segment_name}", response_model=dict)
 def get_segment_info(segment_name: str):
-    with database.get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT segment, description FROM Segments WHERE segment = ?",
-            (segment_name,)
-        )
-        segment = cursor.fetchone()
-        if not segment:
-            raise HTTPException(status_code=404, detail="Segment not found")
-        return dict(segment)
+    segment = engine.get_segment(segment_name)
+    if not segment:
+        raise HTTPException(status_code=404, detail="Segment not found")
+    return segment
 
 
 # Проверить, состоит ли пользователь в сегменте
 @app.get("/users/{user_id}/segments/{segment_name}", response_model=dict)
 def check_user_in_segment(user_id: int, segment_name: str):
-    with database.get_db_connection() as conn:
-        cursor = conn.cursor()
-        # Получаем ID сегмента
-        cursor.execute("SELECT id FROM Segments WHERE segment = ?", (segment_name,))
-        segment = cursor.fetchone()
-        if not segment:
-            raise HTTPException(status_code=404, detail="Segment not found")
+    # Получаем ID сегмента
+    segment_id = engine.get_segment_id(segment_name)
+    if segment_id is None:
+        raise HTTPException(status_code=404, detail="Segment not found")
 
-        # Проверяем связь
-        cursor.execute(
-            "SELECT 1 FROM U_S WHERE user_id = ? AND segment_id = ?",
-            (user_id, segment['id'])
-        )
-        exists = cursor.fetchone() is not None
-        return {
-            "user_id": user_id,
-            "segment": segment_name,
-            "is_member": exists
-        }
+    # Проверяем связь
+    exists = engine.is_user_in_segment(user_id, segment_id)
+    return {
+        "user_id": user_id,
+        "segment": segment_name,
+        "is_member": exists
+    }
 
 
 # Получить информацию о распределении сегмента
 @app.get("/segments/{segment_name}/distribute", response_model=dict)
 def get_distribution_info(segment_name: str):
-    with database.get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT id FROM Segments WHERE segment = ?", (segment_name,))
-        segment = cursor.fetchone()
-        if not segment:
+    def read():
+        segment_id = engine.get_segment_id(segment_name)
+        if segment_id is None:
             raise HTTPException(status_code=404, detail="Segment not found")
 
         # Получаем количество пользователей в сегменте
-        cursor.execute(
-            "SELECT COUNT(*) FROM U_S WHERE segment_id = ?",
-            (segment['id'],)
-        )
-        count = cursor.fetchone()[0]
+        count = engine.count_users_in_segment(segment_id)
 
         # Получаем общее количество пользователей
-        cursor.execute("SELECT COUNT(*) FROM Users")
-        total = cursor.fetchone()[0]
+        total = engine.count_users()
 
         percent = (count / total) * 100 if total > 0 else 0
 
@@ -262,4 +349,12 @@ def get_distribution_info(segment_name: str):
             "user_count": count,
             "total_users": total,
             "percent": round(percent, 2)
-        }
\ No newline at end of file
+        }
+
+    return coalesced(("distribute", segment_name), read)
+
+
+# Счётчики объединения запросов: сколько обращений к БД сэкономлено
+@app.get("/maintenance/coalescing")
+def get_coalescing_stats():
+    return reads.stats()
\ No newline at end of file
@@ -0,0 +1,480 @@
+import os
+import random
+import sqlite3
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+import numpy as np
+
+import database
+from overlap import overlap_matrix
+from split import split_stream
+from storage import StorageEngine
+
+
+# Пометка в журнале: удалить связи сегментов порциями (database._delete_segment_links)
+DELETE_SEGMENT_LINKS = 'delete segment links'
+# Снимок пишется рядом с БД: database.db -> database.db.snapshot
+SNAPSHOT_SUFFIX = '.snapshot'
+
+
+# Отсортированное множество целочисленных id поверх array('q').
+# Занимает 8 байт на элемент вместо объекта int + слота хеш-таблицы у set.
+class IdSet:
+    __slots__ = ('_items',)
+
+    def __init__(self, items=()):
+        self._items = array('q', sorted(set(items)))
+
+    # Создание из уже отсортированной последовательности без дубликатов
+    @classmethod
+    def from_sorted(cls, items):
+        id_set = cls.__new__(cls)
+        id_set._items = array('q', items)
+        return id_set
+
+    def add(self, value):
+        index = bisect_left(self._items, value)
+        if index < len(self._items) and self._items[index] == value:
+            return False
+        self._items.insert(index, value)
+        return True
+
+    def discard(self, value):
+        index = bisect_left(self._items, value)
+        if index < len(self._items) and self._items[index] == value:
+            del self._items[index]
+            return True
+        return False
+
+    def clear(self):
+        self._items = array('q')
+
+    def __contains__(self, value):
+        index = bisect_left(self._items, value)
+        return index < len(self._items) and self._items[index] == value
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(self._items)
+
+    # Копия в виде массива numpy (без поэлементного обхода)
+    def to_numpy(self):
+        return np.array(self._items, dtype=np.int64)
+
+
+# Запись о пользователе
+class UserRecord:
+    __slots__ = ('id', 'name', 'email')
+
+    def __init__(self, id, name, email):
+        self.id = id
+        self.name = name
+        self.email = email
+
+
+# Запись о сегменте
+class SegmentRecord:
+    __slots__ = ('id', 'segment', 'description')
+
+    def __init__(self, id, segment, description):
+        self.id = id
+        self.segment = segment
+        self.description = description
+
+
+# Движок, держащий все данные в памяти.
+# SQLite остаётся надёжным хранилищем: изменения копятся в журнале и
+# записываются фоновым потоком (write-behind), периодически снимается
+# копия БД в отдельный файл.
+class MemoryEngine(StorageEngine):
+    def __init__(self, flush_interval=1.0, snapshot_interval=300.0):
+        self._flush_interval = flush_interval
+        self._snapshot_interval = snapshot_interval
+
+        self._users = {}            # id -> UserRecord
+        self._user_ids = {}         # name -> id
+        self._segments = {}         # id -> SegmentRecord
+        self._segment_ids = {}      # segment -> id
+        self._user_segments = {}    # user_id -> IdSet(segment_id)
+        self._segment_users = {}    # segment_id -> IdSet(user_id)
+        self._next_user_id = 1
+        self._next_segment_id = 1
+
+        # Журнал несохранённых изменений: список (sql, [params, ...])
+        self._pending = []
+        # Защищает состояние в памяти и журнал
+        self._lock = threading.RLock()
+        # Сериализует запись в SQLite и копирование снимка (flush и snapshot)
+        self._io_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        database.init_db()
+        self.load()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='memory-engine-writer', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    # Загрузка всех данных из database.db
+    def load(self):
+        with database.get_db_connection() as connection:
+            # Кортежи вместо sqlite3.Row заметно ускоряют чтение больших таблиц
+            connection.row_factory = None
+            cursor = connection.cursor()
+
+            cursor.execute('SELECT id, name, email FROM Users ORDER BY id')
+            users = {row[0]: UserRecord(*row) for row in cursor}
+
+            cursor.execute('SELECT id, segment, description FROM Segments ORDER BY id')
+            segments = {row[0]: SegmentRecord(*row) for row in cursor}
+
+            # Строки идут в порядке первичного ключа (user_id, segment_id),
+            # поэтому обе стороны связи получаются уже отсортированными
+            user_lists = {}
+            segment_lists = {segment_id: [] for segment_id in segments}
+            cursor.execute('SELECT user_id, segment_id FROM U_S ORDER BY user_id, segment_id')
+            for user_id, segment_id in cursor:
+                if user_id not in users or segment_id not in segments:
+                    continue
+                user_lists.setdefault(user_id, []).append(segment_id)
+                segment_lists[segment_id].append(user_id)
+
+            cursor.execute("SELECT name, seq FROM sqlite_sequence WHERE name IN ('Users', 'Segments')")
+            sequences = dict(cursor.fetchall())
+
+        with self._lock:
+            self._users = users
+            self._user_ids = {user.name: user.id for user in users.values()}
+            self._segments = segments
+            self._segment_ids = {segment.segment: segment.id for segment in segments.values()}
+            self._user_segments = {user_id: IdSet.from_sorted(ids) for user_id, ids in user_lists.items()}
+            self._segment_users = {segment_id: IdSet.from_sorted(ids) for segment_id, ids in segment_lists.items()}
+            self._next_user_id = max(sequences.get('Users', 0), max(users, default=0)) + 1
+            self._next_segment_id = max(sequences.get('Segments', 0), max(segments, default=0)) + 1
+            self._pending = []
+            self._membership_changed()
+
+    # Запись накопленного журнала изменений в SQLite
+    def flush(self):
+        with self._io_lock:
+            with self._lock:
+                operations, self._pending = self._pending, []
+            if not operations:
+                return
+            try:
+                with database.get_db_connection() as connection:
+                    cursor = connection.cursor()
+                    for sql, params in operations:
+                        if sql == DELETE_SEGMENT_LINKS:
+                            # Порции коммитятся отдельно, не раздувая общую транзакцию
+                            for (segment_id,) in params:
+                                database._delete_segment_links(connection, segment_id)
+                        else:
+                            cursor.executemany(sql, params)
+                    database._bump_membership_version(connection)
+                    connection.commit()
+            except Exception:
+                # Возвращаем изменения в начало журнала, чтобы не потерять их
+                with self._lock:
+                    self._pending[:0] = operations
+                raise
+
+    # Копия БД после записи журнала в отдельный файл (database.db.snapshot).
+    # Рабочая БД не переписывается: журнал и так держит её в актуальном состоянии.
+    # Копия собирается во временном файле и подменяет прежний снимок атомарно
+    def snapshot(self):
+        self.flush()
+        path = database.DATABASE + SNAPSHOT_SUFFIX
+        temp_path = path + '.tmp'
+        with self._io_lock:
+            with database.get_db_connection() as connection:
+                target = sqlite3.connect(temp_path)
+                try:
+                    connection.backup(target)
+                finally:
+                    target.close()
+        os.replace(temp_path, path)
+        return path
+
+    # Фоновый поток write-behind
+    def _run(self):
+        last_snapshot = time.monotonic()
+        while not self._stop.wait(self._flush_interval):
+            try:
+                if time.monotonic() - last_snapshot >= self._snapshot_interval:
+                    self.snapshot()
+                    last_snapshot = time.monotonic()
+                else:
+                    self.flush()
+            except Exception as e:
+                print(f"Memory engine write-behind failed: {e}")
+
+    def _enqueue(self, sql, params):
+        self._pending.append((sql, params))
+
+    def _link(self, user_id, segment_id):
+        self._user_segments.setdefault(user_id, IdSet()).add(segment_id)
+        return self._segment_users[segment_id].add(user_id)
+
+    def _unlink(self, user_id, segment_id):
+        segment_ids = self._user_segments.get(user_id)
+        if segment_ids is not None:
+            segment_ids.discard(segment_id)
+            if not segment_ids:
+                del self._user_segments[user_id]
+        return self._segment_users[segment_id].discard(user_id)
+
+    def _clear_segment(self, segment_id):
+        user_ids = list(self._segment_users[segment_id])
+        for user_id in user_ids:
+            self._unlink(user_id, segment_id)
+        return user_ids
+
+    def _require_segment_id(self, segment):
+        segment_id = self._segment_ids.get(segment)
+        if segment_id is None:
+            raise ValueError(f"Segment {segment} not found")
+        return segment_id
+
+    # Добавление пользователя
+    def add_user(self, name, email=None):
+        with self._lock:
+            if name in self._user_ids:
+                return
+            user_id = self._next_user_id
+            self._next_user_id += 1
+            self._users[user_id] = UserRecord(user_id, name, email)
+            self._user_ids[name] = user_id
+            self._enqueue('INSERT OR IGNORE INTO Users (id, name, email) VALUES (?, ?, ?)', [(user_id, name, email)])
+
+    # Добавление пользователя в сегмент
+    def add_user_to_segment(self, user_id, segment_id):
+        with self._lock:
+            if user_id not in self._users or segment_id not in self._segments:
+                return False
+            if not self._link(user_id, segment_id):
+                return False
+            self._enqueue('INSERT OR IGNORE INTO U_S (user_id, segment_id) VALUES (?, ?)', [(user_id, segment_id)])
+            self._membership_changed()
+            return True
+
+    # Удаление пользователя из сегмента
+    def delete_user_in_segment(self, user_id, segment_id):
+        with self._lock:
+            if segment_id not in self._segments:
+                return
+            if self._unlink(user_id, segment_id):
+                self._enqueue('DELETE FROM U_S WHERE user_id = ? AND segment_id = ?', [(user_id, segment_id)])
+                self._membership_changed()
+
+    # Добавление сегмента
+    def add_segment(self, segment, description):
+        with self._lock:
+            if segment in self._segment_ids:
+                return
+            segment_id = self._next_segment_id
+            self._next_segment_id += 1
+            self._segments[segment_id] = SegmentRecord(segment_id, segment, description)
+            self._segment_ids[segment] = segment_id
+            self._segment_users[segment_id] = IdSet()
+            self._enqueue(
+                'INSERT OR IGNORE INTO Segments (id, segment, description) VALUES (?, ?, ?)',
+                [(segment_id, segment, description)]
+            )
+            self._membership_changed()
+
+    # Удаление сегмента вместе со всеми его связями
+    def delete_segment(self, segment):
+        with self._lock:
+            segment_id = self._segment_ids.pop(segment, None)
+            if segment_id is None:
+                return
+            self._clear_segment(segment_id)
+            del self._segment_users[segment_id]
+            del self._segments[segment_id]
+            self._enqueue(DELETE_SEGMENT_LINKS, [(segment_id,)])
+            self._enqueue('DELETE FROM Segments WHERE id = ?', [(segment_id,)])
+            self._membership_changed()
+
+    # Распределение сегмента на N% пользователей
+    def distribute_segment_to_percent(self, segment_id, percent):
+        with self._lock:
+            if segment_id not in self._segments:
+                return
+            self._clear_segment(segment_id)
+            sample_size = min(max(int(len(self._users) * percent / 100), 0), len(self._users))
+            user_ids = sorted(random.sample(list(self._users), sample_size))
+            for user_id in user_ids:
+                self._link(user_id, segment_id)
+            self._enqueue('DELETE FROM U_S WHERE segment_id = ?', [(segment_id,)])
+            self._enqueue(
+                'INSERT OR IGNORE INTO U_S (user_id, segment_id) VALUES (?, ?)',
+                [(user_id, segment_id) for user_id in user_ids]
+            )
+            self._membership_changed()
+
+    # Получение сегментов пользователя
+    def get_user_segments(self, user_id):
+        with self._lock:
+            return [self._segments[segment_id].segment for segment_id in self._user_segments.get(user_id, ())]
+
+    # Получение сегментов сразу для нескольких пользователей
+    def get_users_segments(self, user_ids):
+        with self._lock:
+            return {
+                user_id: [self._segments[segment_id].segment for segment_id in self._user_segments.get(user_id, ())]
+                for user_id in user_ids
+            }
+
+    # Получение пользователей в сегменте
+    def get_users_in_segment(self, segment):
+        with self._lock:
+            segment_id = self._segment_ids.get(segment)
+            if segment_id is None:
+                return []
+            return [self._users[user_id].name for user_id in self._segment_users[segment_id]]
+
+    # Получение статистики по сегментам
+    def get_segments_stats(self):
+        with self._lock:
+            return [
+                {'segment': segment.segment, 'user_count': len(self._segment_users[segment.id])}
+                for segment in sorted(self._segments.values(), key=lambda s: s.segment)
+            ]
+
+    # Обновление описания сегмента
+    def update_segment_description(self, segment, new_description):
+        with self._lock:
+            segment_id = self._segment_ids.get(segment)
+            if segment_id is None:
+                return
+            self._segments[segment_id].description = new_description
+            self._enqueue('UPDATE Segments SET description = ? WHERE id = ?', [(new_description, segment_id)])
+
+    # Перенос пользователей между сегментами
+    def move_users_between_segments(self, from_segment_name, to_segment_name):
+        with self._lock:
+            from_segment_id = self._require_segment_id(from_segment_name)
+            to_segment_id = self._require_segment_id(to_segment_name)
+            if from_segment_id == to_segment_id:
+                return
+            user_ids = self._clear_segment(from_segment_id)
+            for user_id in user_ids:
+                self._link(user_id, to_segment_id)
+            self._enqueue('DELETE FROM U_S WHERE segment_id = ?', [(from_segment_id,)])
+            self._enqueue(
+                'INSERT OR IGNORE INTO U_S (user_id, segment_id) VALUES (?, ?)',
+                [(user_id, to_segment_id) for user_id in user_ids]
+            )
+            self._membership_changed()
+
+    # Получение списка всех пользователей
+    def get_all_users(self):
+        with self._lock:
+            return [{'id': user.id, 'name': user.name, 'email': user.email} for user in self._users.values()]
+
+    # Получение списка всех сегментов
+    def get_all_segments(self):
+        with self._lock:
+            return [
+                {'segment': segment.segment, 'description': segment.description}
+                for segment in self._segments.values()
+            ]
+
+    # Получение информации о сегменте (None, если сегмента нет)
+    def get_segment(self, segment):
+        with self._lock:
+            segment_id = self._segment_ids.get(segment)
+            if segment_id is None:
+                return None
+            record = self._segments[segment_id]
+            return {'segment': record.segment, 'description': record.description}
+
+    # Получение ID сегмента по названию (None, если сегмента нет)
+    def get_segment_id(self, segment):
+        with self._lock:
+            return self._segment_ids.get(segment)
+
+    # Проверка, состоит ли пользователь в сегменте
+    def is_user_in_segment(self, user_id, segment_id):
+        with self._lock:
+            user_ids = self._segment_users.get(segment_id)
+            return user_ids is not None and user_id in user_ids
+
+    # Количество пользователей в сегменте
+    def count_users_in_segment(self, segment_id):
+        with self._lock:
+            return len(self._segment_users.get(segment_id, ()))
+
+    # Общее количество пользователей
+    def count_users(self):
+        with self._lock:
+            return len(self._users)
+
+    # Взаимоисключающее распределение сегментов по долям за один проход
+    def split_segments(self, segment_ids, percents, stratify_segment_id=None):
+        with self._lock:
+            for segment_id in segment_ids:
+                self._clear_segment(segment_id)
+
+            if stratify_segment_id is None:
+                strata_sizes = {False: len(self._users)}
+                users = ((user_id, False) for user_id in self._users)
+            else:
+                members = self._segment_users[stratify_segment_id]
+                strata_sizes = {False: len(self._users) - len(members), True: len(members)}
+                users = ((user_id, user_id in members) for user_id in self._users)
+
+            arms = split_stream(users, strata_sizes, percents)
+
+            for segment_id, user_ids in zip(segment_ids, arms):
+                self._segment_users[segment_id] = IdSet.from_sorted(user_ids)
+                for user_id in user_ids:
+                    self._user_segments.setdefault(user_id, IdSet()).add(segment_id)
+            self._enqueue(
+                'DELETE FROM U_S WHERE segment_id = ?',
+                [(segment_id,) for segment_id in segment_ids]
+            )
+            for segment_id, user_ids in zip(segment_ids, arms):
+                self._enqueue(
+                    'INSERT OR IGNORE INTO U_S (user_id, segment_id) VALUES (?, ?)',
+                    [(user_id, segment_id) for user_id in user_ids]
+                )
+            self._membership_changed()
+            return [len(user_ids) for user_ids in arms]
+
+    # Сжатие SQLite после записи журнала; в памяти осиротевших связей не бывает
+    def compact_storage(self, convert=False):
+        self.flush()
+        with self._io_lock:
+            return database.compact_storage(convert)
+
+    # Матрица пересечений по массивам id пользователей каждого сегмента
+    def _compute_segments_overlap(self):
+        with self._lock:
+            segments = sorted(self._segments.values(), key=lambda s: s.segment)
+            user_ids = [self._segment_users[segment.id].to_numpy() for segment in segments]
+        sizes = [len(ids) for ids in user_ids]
+        columns = np.repeat(np.arange(len(segments), dtype=np.int64), sizes)
+        matrix = overlap_matrix(
+            np.concatenate(user_ids) if user_ids else np.empty(0, dtype=np.int64),
+            columns,
+            len(segments)
+        )
+        return {
+            'segments': [segment.segment for segment in segments],
+            'matrix': matrix.tolist()
+        }
@@ -0,0 +1,50 @@
+import numpy as np
+
+
+# Сколько пар (сегмент, сегмент) обрабатывается за один шаг
+PAIR_BLOCK_SIZE = 1 << 20
+
+
+# Матрица пересечений сегментов: overlap[i][j] – число пользователей,
+# состоящих одновременно в сегментах i и j (на диагонали – размер сегмента).
+# user_ids и columns – параллельные массивы связей (id пользователя, номер сегмента).
+# Для каждого пользователя перечисляются пары его сегментов, коды пар i * size + j
+# считаются через np.bincount. Работа и память пропорциональны числу пар
+# сегментов у пользователей, а не пользователи × сегменты.
+def overlap_matrix(user_ids, columns, size):
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    columns = np.asarray(columns, dtype=np.int64)
+    result = np.zeros(size * size, dtype=np.int64)
+    if size == 0 or user_ids.size == 0:
+        return result.reshape(size, size)
+
+    order = np.argsort(user_ids, kind='stable')
+    _, rows = np.unique(user_ids[order], return_inverse=True)
+    columns = columns[order]
+
+    # Связи каждого пользователя идут подряд: с позиции starts[u], counts[u] штук
+    counts = np.bincount(rows)
+    starts = np.cumsum(counts) - counts
+    pairs_total = np.cumsum(counts * counts)
+
+    users_count = counts.size
+    first_user = 0
+    while first_user < users_count:
+        done = pairs_total[first_user - 1] if first_user else 0
+        last_user = int(np.searchsorted(pairs_total, done + PAIR_BLOCK_SIZE, side='right'))
+        last_user = max(last_user, first_user + 1)
+
+        low = starts[first_user]
+        high = starts[last_user - 1] + counts[last_user - 1]
+        block_rows = rows[low:high]
+        repeats = counts[block_rows]
+
+        # Каждая связь пользователя в паре со всеми его связями
+        left = np.repeat(columns[low:high], repeats)
+        offsets = np.arange(repeats.sum()) - np.repeat(np.cumsum(repeats) - repeats, repeats)
+        right = columns[np.repeat(starts[block_rows], repeats) + offsets]
+        result += np.bincount(left * size + right, minlength=size * size)
+
+        first_user = last_user
+
+    return result.reshape(size, size)
@@ -0,0 +1,75 @@
+import threading
+import time
+
+
+# Один вызов для ключа: результат (или ошибка) и момент завершения
+class _Call:
+    __slots__ = ('event', 'result', 'error', 'finished')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.finished = None
+
+
+# Объединение одновременных одинаковых запросов: пока вызов для ключа выполняется
+# (и ещё grace секунд после завершения), остальные потоки получают его результат
+# вместо повторного обращения к БД.
+class SingleFlight:
+    def __init__(self, grace=0.0):
+        self.grace = grace
+        self.executions = 0
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def _expired(self, call, now):
+        return call.finished is not None and now - call.finished >= self.grace
+
+    def do(self, key, fn):
+        with self._lock:
+            now = time.monotonic()
+            call = self._calls.get(key)
+            leader = call is None or self._expired(call, now)
+            if leader:
+                # Заодно убираем завершённые вызовы по другим ключам
+                for stale_key in [k for k, c in self._calls.items() if self._expired(c, now)]:
+                    del self._calls[stale_key]
+                call = _Call()
+                self._calls[key] = call
+                self.executions += 1
+            else:
+                self.shared += 1
+
+        if leader:
+            try:
+                call.result = fn()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    call.finished = time.monotonic()
+                    if self.grace <= 0 and self._calls.get(key) is call:
+                        del self._calls[key]
+                call.event.set()
+        else:
+            call.event.wait()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    # Забыть все вызовы: следующие запросы выполнятся заново.
+    # Уже выполняющиеся вызовы дорабатывают и отдают результат своим ожидающим
+    def clear(self):
+        with self._lock:
+            self._calls.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'executions': self.executions,
+                'saved': self.shared,
+                'in_flight': sum(1 for call in self._calls.values() if call.finished is None)
+            }
@@ -0,0 +1,36 @@
+import random
+from array import array
+
+
+# Размеры рукавов для группы из size пользователей (округление вниз,
+# как в distribute_segment_to_percent)
+def arm_quotas(size, percents):
+    return [int(size * percent / 100) for percent in percents]
+
+
+# Взаимоисключающее распределение пользователей по рукавам за один проход.
+# users – поток пар (user_id, страта), strata_sizes – число пользователей в каждой страте.
+# Последовательная выборка: очередной пользователь попадает в рукав k с вероятностью
+# (оставшаяся квота k) / (оставшиеся пользователи страты), поэтому размеры рукавов
+# получаются точными, а каждый пользователь попадает не более чем в один рукав.
+def split_stream(users, strata_sizes, percents, rng=random):
+    remaining = dict(strata_sizes)
+    quotas = {stratum: arm_quotas(size, percents) for stratum, size in strata_sizes.items()}
+    arms = [array('q') for _ in percents]
+
+    for user_id, stratum in users:
+        left = remaining.get(stratum, 0)
+        if left <= 0:
+            continue
+        remaining[stratum] = left - 1
+
+        stratum_quotas = quotas[stratum]
+        draw = rng.randrange(left)
+        for arm, quota in enumerate(stratum_quotas):
+            if draw < quota:
+                stratum_quotas[arm] -= 1
+                arms[arm].append(user_id)
+                break
+            draw -= quota
+
+    return arms
@@ -0,0 +1,226 @@
+import os
+from abc import ABC, abstractmethod
+
+import database
+
+
+# Интерфейс хранилища, через который main.py работает с данными.
+# Все реализации должны возвращать одинаковые результаты.
+class StorageEngine(ABC):
+    # Версия связей пользователей и сегментов в этом процессе
+    _membership_version = 0
+    # Кэш матрицы пересечений: (версия, результат)
+    _overlap_cache = None
+
+    # Подготовка хранилища при старте сервиса
+    @abstractmethod
+    def start(self):
+        ...
+
+    # Освобождение ресурсов при остановке сервиса
+    @abstractmethod
+    def close(self):
+        ...
+
+    @abstractmethod
+    def add_user(self, name, email=None):
+        ...
+
+    # Возвращает True, если связь добавлена (False – уже была или нет пользователя/сегмента)
+    @abstractmethod
+    def add_user_to_segment(self, user_id, segment_id):
+        ...
+
+    @abstractmethod
+    def delete_user_in_segment(self, user_id, segment_id):
+        ...
+
+    @abstractmethod
+    def add_segment(self, segment, description):
+        ...
+
+    @abstractmethod
+    def delete_segment(self, segment):
+        ...
+
+    @abstractmethod
+    def distribute_segment_to_percent(self, segment_id, percent):
+        ...
+
+    @abstractmethod
+    def get_user_segments(self, user_id):
+        ...
+
+    # Сегменты нескольких пользователей: {user_id: [segment, ...]}
+    @abstractmethod
+    def get_users_segments(self, user_ids):
+        ...
+
+    @abstractmethod
+    def get_users_in_segment(self, segment):
+        ...
+
+    @abstractmethod
+    def get_segments_stats(self):
+        ...
+
+    @abstractmethod
+    def update_segment_description(self, segment, new_description):
+        ...
+
+    @abstractmethod
+    def move_users_between_segments(self, from_segment_name, to_segment_name):
+        ...
+
+    @abstractmethod
+    def get_all_users(self):
+        ...
+
+    @abstractmethod
+    def get_all_segments(self):
+        ...
+
+    @abstractmethod
+    def get_segment(self, segment):
+        ...
+
+    @abstractmethod
+    def get_segment_id(self, segment):
+        ...
+
+    @abstractmethod
+    def is_user_in_segment(self, user_id, segment_id):
+        ...
+
+    @abstractmethod
+    def count_users_in_segment(self, segment_id):
+        ...
+
+    @abstractmethod
+    def count_users(self):
+        ...
+
+    # Взаимоисключающее распределение сегментов по долям, возвращает размеры рукавов
+    @abstractmethod
+    def split_segments(self, segment_ids, percents, stratify_segment_id=None):
+        ...
+
+    # Очистка осиротевших связей и сжатие БД, возвращает отчёт об освобождённом месте
+    @abstractmethod
+    def compact_storage(self, convert=False):
+        ...
+
+    # Вычисление матрицы пересечений сегментов
+    @abstractmethod
+    def _compute_segments_overlap(self):
+        ...
+
+    # Отметка об изменении связей, сбрасывает кэш матрицы пересечений
+    def _membership_changed(self):
+        self._membership_version += 1
+
+    # Версия, по которой проверяется актуальность кэша
+    def _current_membership_version(self):
+        return self._membership_version
+
+    # Матрица пересечений сегментов, кэшируется до изменения связей
+    def get_segments_overlap(self):
+        version = self._current_membership_version()
+        cache = self._overlap_cache
+        if cache is None or cache[0] != version:
+            cache = (version, self._compute_segments_overlap())
+            self._overlap_cache = cache
+        return cache[1]
+
+
+# Движок по умолчанию: каждый вызов сразу идёт в SQLite через database.py
+class SQLiteEngine(StorageEngine):
+    def start(self):
+        database.init_db()
+
+    def close(self):
+        pass
+
+    def add_user(self, name, email=None):
+        database.add_user(name, email)
+
+    def add_user_to_segment(self, user_id, segment_id):
+        return database.add_user_to_segment(user_id, segment_id)
+
+    def delete_user_in_segment(self, user_id, segment_id):
+        database.delete_user_in_segment(user_id, segment_id)
+
+    def add_segment(self, segment, description):
+        database.add_segment(segment, description)
+
+    def delete_segment(self, segment):
+        database.delete_segment(segment)
+
+    def distribute_segment_to_percent(self, segment_id, percent):
+        database.distribute_segment_to_percent(segment_id, percent)
+
+    def get_user_segments(self, user_id):
+        return database.get_user_segments(user_id)
+
+    def get_users_segments(self, user_ids):
+        return database.get_users_segments(user_ids)
+
+    def get_users_in_segment(self, segment):
+        return database.get_users_in_segment(segment)
+
+    def get_segments_stats(self):
+        return database.get_segments_stats()
+
+    def update_segment_description(self, segment, new_description):
+        database.update_segment_description(segment, new_description)
+
+    def move_users_between_segments(self, from_segment_name, to_segment_name):
+        database.move_users_between_segments(from_segment_name, to_segment_name)
+
+    def get_all_users(self):
+        return database.get_all_users()
+
+    def get_all_segments(self):
+        return database.get_all_segments()
+
+    def get_segment(self, segment):
+        return database.get_segment(segment)
+
+    def get_segment_id(self, segment):
+        return database.get_segment_id(segment)
+
+    def is_user_in_segment(self, user_id, segment_id):
+        return database.is_user_in_segment(user_id, segment_id)
+
+    def count_users_in_segment(self, segment_id):
+        return database.count_users_in_segment(segment_id)
+
+    def count_users(self):
+        return database.count_users()
+
+    def split_segments(self, segment_ids, percents, stratify_segment_id=None):
+        return database.split_segments(segment_ids, percents, stratify_segment_id)
+
+    def compact_storage(self, convert=False):
+        return database.compact_storage(convert)
+
+    # Версия хранится в БД и учитывает изменения из других процессов
+    def _current_membership_version(self):
+        return database.get_membership_version()
+
+    def _compute_segments_overlap(self):
+        return database.get_segments_overlap()
+
+
+# Выбор движка по переменной окружения SEGMENT_STORAGE (sqlite | memory)
+def create_engine(name=None):
+    name = (name or os.environ.get('SEGMENT_STORAGE', 'sqlite')).lower()
+    if name == 'sqlite':
+        return SQLiteEngine()
+    if name == 'memory':
+        from memory_engine import MemoryEngine
+        return MemoryEngine(
+            flush_interval=float(os.environ.get('SEGMENT_FLUSH_INTERVAL', '1.0')),
+            snapshot_interval=float(os.environ.get('SEGMENT_SNAPSHOT_INTERVAL', '300')),
+        )
+    raise ValueError(f"Unknown storage engine: {name}")
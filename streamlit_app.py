@@ -1,6 +1,7 @@
 import streamlit as st
 import requests
 import pandas as pd
+import altair as alt
 
 # Конфигурация API
 API_BASE_URL = "http://127.0.0.1:8000"
@@ -292,12 +293,38 @@ def show_statistics_page():
 
             # Визуализация
             st.subheader("Визуализация")
-            st.bar_chart(stats_df.set_index('segment')['user_count'])
+            col1, col2 = st.columns(2)
+            with col1:
+                st.bar_chart(stats_df.set_index('segment')['user_count'])
+            with col2:
+                show_overlap_heatmap()
         else:
             st.info("Статистические данные отсутствуют")
     except Exception as e:
         st.error(f"Не удалось загрузить статистику: {str(e)}")
 
 
+# Тепловая карта пересечений сегментов
+def show_overlap_heatmap():
+    try:
+        overlap = requests.get(f"{API_BASE_URL}/segments/overlap").json()
+        segments = overlap['segments']
+        overlap_df = pd.DataFrame(overlap['matrix'], index=segments, columns=segments)
+        overlap_df = overlap_df.rename_axis('Сегмент 1').reset_index().melt(
+            id_vars='Сегмент 1', var_name='Сегмент 2', value_name='Пользователей'
+        )
+
+        heatmap = alt.Chart(overlap_df).mark_rect().encode(
+            x=alt.X('Сегмент 1:N'),
+            y=alt.Y('Сегмент 2:N'),
+            color=alt.Color('Пользователей:Q', scale=alt.Scale(scheme='blues')),
+            tooltip=['Сегмент 1', 'Сегмент 2', 'Пользователей']
+        )
+        labels = heatmap.mark_text().encode(text='Пользователей:Q', color=alt.value('black'))
+        st.altair_chart(heatmap + labels, use_container_width=True)
+    except Exception as e:
+        st.error(f"Не удалось загрузить пересечения сегментов: {str(e)}")
+
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+import storage  # noqa: E402
+
+
+# Оба движка хранения поверх временного database.db
+@pytest.fixture(params=['sqlite', 'memory'])
+def engine(request, tmp_path, monkeypatch):
+    monkeypatch.setattr(database, 'DATABASE', str(tmp_path / 'database.db'))
+    engine = storage.create_engine(request.param)
+    engine.start()
+    yield engine
+    engine.close()
+
+
+# API поверх движка из фикстуры engine (без lifespan: движок уже запущен)
+@pytest.fixture
+def api(engine, monkeypatch):
+    import main
+    from fastapi.testclient import TestClient
+    from singleflight import SingleFlight
+
+    monkeypatch.setattr(main, 'engine', engine)
+    monkeypatch.setattr(main, 'reads', SingleFlight())
+    return TestClient(main.app)
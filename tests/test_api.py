@@ -0,0 +1,33 @@
+def test_unknown_segment_is_404(api):
+    assert api.post('/users/1/segments/NOPE').status_code == 404
+    assert api.delete('/users/1/segments/NOPE').status_code == 404
+    assert api.post('/segments/NOPE/distribute', json={'percent': 50}).status_code == 404
+
+
+def test_unknown_user_is_404(api):
+    response = api.post('/users/404/segments/MAIL_GPT')
+    assert response.status_code == 404
+    assert response.json()['detail'] == 'User not found'
+
+    assert api.post('/users/1/segments/MAIL_GPT').status_code == 200
+    # Повторное добавление – не ошибка
+    assert api.post('/users/1/segments/MAIL_GPT').status_code == 200
+
+
+def test_split_validation(api):
+    def split(arms, **extra):
+        return api.post('/segments/split', json={
+            'arms': [{'segment': name, 'percent': percent} for name, percent in arms], **extra
+        })
+
+    assert split([]).status_code == 400
+    assert split([('MAIL_GPT', 60), ('MAIL_VOICE_MESSAGES', 41)]).status_code == 400
+    assert split([('MAIL_GPT', -1), ('MAIL_VOICE_MESSAGES', 50)]).status_code == 400
+    assert split([('MAIL_GPT', 30), ('MAIL_GPT', 30)]).status_code == 400
+    assert split([('MAIL_GPT', 50)], stratify_by='MAIL_GPT').status_code == 400
+    assert split([('MAIL_GPT', 50), ('NOPE', 10)]).status_code == 404
+    assert split([('MAIL_GPT', 50)], stratify_by='NOPE').status_code == 404
+
+    response = split([('MAIL_GPT', 40), ('MAIL_VOICE_MESSAGES', 40)], stratify_by='CLOUD_DISCOUNT_30')
+    assert response.status_code == 200
+    assert response.json()['counts'] == {'MAIL_GPT': 2, 'MAIL_VOICE_MESSAGES': 2}
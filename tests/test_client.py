@@ -0,0 +1,178 @@
+import asyncio
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from client import AsyncSegmentClient, SegmentClient
+
+
+# Подмена SegmentClient._request: отвечает на пакетное чтение и запоминает запросы
+class FakeApi:
+    def __init__(self, delay=0.0, error=None):
+        self.delay = delay
+        self.error = error
+        self.batches = []
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def __call__(self, method, path, session=None, **kwargs):
+        with self._lock:
+            self.requests.append((method, path))
+        if path != '/users/segments/batch':
+            return {}
+        user_ids = kwargs['json']['user_ids']
+        with self._lock:
+            self.batches.append(len(user_ids))
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        # Нечётные пользователи состоят в сегменте A; ключи – строки, как в JSON
+        return {str(user_id): ['A'] if user_id % 2 else [] for user_id in user_ids}
+
+
+def make_client(api, **kwargs):
+    client = SegmentClient('http://segments.test', **kwargs)
+    client._request = api
+    return client
+
+
+def test_concurrent_lookups_are_batched():
+    api = FakeApi(delay=0.02)
+    client = make_client(api, max_batch=16)
+
+    with ThreadPoolExecutor(32) as executor:
+        results = list(executor.map(lambda user_id: client.is_member(user_id, 'A'), range(200)))
+
+    assert results == [bool(user_id % 2) for user_id in range(200)]
+    assert sum(api.batches) == 200
+    assert len(api.batches) < 50
+    assert max(api.batches) <= 16
+
+
+def test_sender_returns_under_steady_load():
+    api = FakeApi(delay=0.02)
+    client = make_client(api, cache_ttl=0)
+    waits = []
+    stop = time.monotonic() + 1.0
+
+    def worker():
+        while time.monotonic() < stop:
+            start = time.perf_counter()
+            client.get_user_segments(random.randrange(10 ** 6))
+            waits.append(time.perf_counter() - start)
+            time.sleep(random.uniform(0, 0.05))
+
+    threads = [threading.Thread(target=worker) for _ in range(32)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Отправитель отдаёт роль после одного пакета, а не обслуживает чужие запросы
+    assert max(waits) < 0.5
+    assert len(api.batches) < len(waits)
+
+
+def test_fetch_error_reaches_every_waiter():
+    api = FakeApi(delay=0.05, error=RuntimeError('service unavailable'))
+    client = make_client(api)
+
+    def lookup(user_id):
+        with pytest.raises(RuntimeError, match='service unavailable'):
+            client.get_user_segments(user_id)
+        return True
+
+    with ThreadPoolExecutor(8) as executor:
+        assert all(executor.map(lookup, range(8)))
+    assert sum(api.batches) == 8
+    assert len(api.batches) < 8
+
+
+def test_serial_lookup_is_sent_at_once():
+    api = FakeApi()
+    client = make_client(api, cache_ttl=0)
+
+    start = time.perf_counter()
+    for user_id in range(50):
+        client.get_user_segments(user_id)
+
+    assert api.batches == [1] * 50
+    assert time.perf_counter() - start < 0.5
+
+
+def test_cache_ttl_zero_disables_cache():
+    api = FakeApi()
+    client = make_client(api, cache_ttl=0)
+
+    assert client.is_member(1, 'A')
+    assert client.is_member(1, 'A')
+    assert client.get_users_segments([1, 2]) == {1: ['A'], 2: []}
+    client.invalidate(1)
+
+    assert api.batches == [1, 1, 2]
+
+
+def test_writes_invalidate_cache():
+    api = FakeApi()
+    client = make_client(api)
+
+    client.get_user_segments(1)
+    client.get_user_segments(2)
+    assert api.batches == [1, 1]
+
+    # Изменение связей пользователя сбрасывает только его запись
+    client.add_user_to_segment(1, 'A')
+    client.get_user_segments(1)
+    client.get_user_segments(2)
+    assert api.batches == [1, 1, 1]
+
+    # Массовые операции сбрасывают весь кэш
+    client.distribute_segment('A', 50)
+    client.get_users_segments([1, 2])
+    assert api.batches == [1, 1, 1, 2]
+    assert ('POST', '/segments/A/distribute') in api.requests
+
+
+def test_get_users_segments_chunks_missing_ids():
+    api = FakeApi()
+    client = make_client(api, max_batch=500)
+    client.get_users_segments(range(100))
+
+    result = client.get_users_segments(range(1200))
+
+    assert api.batches == [100, 500, 500, 100]
+    assert len(result) == 1200
+    assert result[7] == ['A'] and result[8] == []
+
+
+def test_async_client_batches_and_chunks():
+    api = FakeApi(delay=0.01)
+
+    async def run():
+        async with AsyncSegmentClient('http://segments.test', max_batch=100) as client:
+            client._client._request = api
+            return await asyncio.gather(*(client.is_member(user_id, 'A') for user_id in range(250)))
+
+    results = asyncio.run(run())
+
+    assert results == [bool(user_id % 2) for user_id in range(250)]
+    assert api.batches == [100, 100, 50]
+
+
+def test_async_client_propagates_errors():
+    api = FakeApi(error=RuntimeError('service unavailable'))
+
+    async def run():
+        async with AsyncSegmentClient('http://segments.test', cache_ttl=0) as client:
+            client._client._request = api
+            return await asyncio.gather(
+                *(client.get_user_segments(user_id) for user_id in range(10)), return_exceptions=True
+            )
+
+    results = asyncio.run(run())
+
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert api.batches == [10]
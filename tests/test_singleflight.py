@@ -0,0 +1,37 @@
+import threading
+import time
+
+from singleflight import SingleFlight
+
+
+def test_concurrent_calls_share_one_execution():
+    reads = SingleFlight()
+    executions = []
+
+    def slow_read():
+        executions.append(1)
+        time.sleep(0.1)
+        return b'result'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(reads.do('stats', slow_read))) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(executions) == 1
+    assert results == [b'result'] * 10
+    assert reads.stats() == {'executions': 1, 'saved': 9, 'in_flight': 0}
+
+
+def test_clear_drops_grace_window_results():
+    reads = SingleFlight(grace=60)
+    value = ['before']
+
+    assert reads.do('stats', lambda: value[0]) == 'before'
+    value[0] = 'after'
+    assert reads.do('stats', lambda: value[0]) == 'before'
+
+    reads.clear()
+    assert reads.do('stats', lambda: value[0]) == 'after'
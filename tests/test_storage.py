@@ -0,0 +1,324 @@
+import database
+import overlap
+import storage
+
+
+# Начальные данные init_db: 5 пользователей и 3 сегмента
+SEEDED_SEGMENTS = ['CLOUD_DISCOUNT_30', 'MAIL_GPT', 'MAIL_VOICE_MESSAGES']
+
+
+def segment_counts(engine):
+    return {row['segment']: row['user_count'] for row in engine.get_segments_stats()}
+
+
+def test_add_link_unlink(engine):
+    engine.add_user('999', 'new@example.com')
+    engine.add_segment('TEST', 'Тестовый сегмент')
+    segment_id = engine.get_segment_id('TEST')
+    gpt_id = engine.get_segment_id('MAIL_GPT')
+
+    for user_id in (1, 2, 6):
+        engine.add_user_to_segment(user_id, segment_id)
+    engine.add_user_to_segment(2, gpt_id)
+    engine.delete_user_in_segment(1, segment_id)
+
+    assert engine.get_user_segments(2) == ['MAIL_GPT', 'TEST']
+    assert engine.get_user_segments(1) == []
+    assert engine.get_users_in_segment('TEST') == ['231', '999']
+    assert engine.is_user_in_segment(6, segment_id)
+    assert not engine.is_user_in_segment(1, segment_id)
+    assert engine.count_users_in_segment(segment_id) == 2
+    assert engine.count_users() == 6
+    assert engine.get_users_segments([1, 2, 6]) == {1: [], 2: ['MAIL_GPT', 'TEST'], 6: ['TEST']}
+
+
+def test_duplicates_are_ignored(engine):
+    engine.add_user('123', 'other@example.com')
+    engine.add_segment('MAIL_GPT', 'Другое описание')
+    gpt_id = engine.get_segment_id('MAIL_GPT')
+    engine.add_user_to_segment(1, gpt_id)
+    engine.add_user_to_segment(1, gpt_id)
+
+    assert engine.count_users() == 5
+    assert engine.get_segment('MAIL_GPT') == {'segment': 'MAIL_GPT', 'description': 'Интеграция GPT в почту'}
+    assert engine.count_users_in_segment(gpt_id) == 1
+
+
+def test_distribute(engine):
+    segment_id = engine.get_segment_id('MAIL_GPT')
+    engine.distribute_segment_to_percent(segment_id, 40)
+    assert engine.count_users_in_segment(segment_id) == 2
+
+    # Повторное распределение заменяет прежнее
+    engine.distribute_segment_to_percent(segment_id, 60)
+    assert engine.count_users_in_segment(segment_id) == 3
+    assert len(engine.get_users_in_segment('MAIL_GPT')) == 3
+
+
+def test_distribute_out_of_range_percent(engine):
+    segment_id = engine.get_segment_id('MAIL_GPT')
+    engine.distribute_segment_to_percent(segment_id, 150)
+    assert engine.count_users_in_segment(segment_id) == 5
+
+    engine.distribute_segment_to_percent(segment_id, -10)
+    assert engine.count_users_in_segment(segment_id) == 0
+
+
+def test_move_users(engine):
+    gpt_id = engine.get_segment_id('MAIL_GPT')
+    cloud_id = engine.get_segment_id('CLOUD_DISCOUNT_30')
+    for user_id in (1, 2):
+        engine.add_user_to_segment(user_id, gpt_id)
+    engine.add_user_to_segment(2, cloud_id)
+
+    engine.move_users_between_segments('MAIL_GPT', 'CLOUD_DISCOUNT_30')
+
+    assert engine.get_users_in_segment('MAIL_GPT') == []
+    assert engine.get_users_in_segment('CLOUD_DISCOUNT_30') == ['123', '231']
+    assert engine.get_user_segments(2) == ['CLOUD_DISCOUNT_30']
+
+
+def test_delete_segment(engine):
+    engine.add_segment('TEST', None)
+    segment_id = engine.get_segment_id('TEST')
+    for user_id in (1, 2, 3):
+        engine.add_user_to_segment(user_id, segment_id)
+
+    engine.delete_segment('TEST')
+
+    assert engine.get_segment('TEST') is None
+    assert engine.get_segment_id('TEST') is None
+    assert engine.get_user_segments(1) == []
+    assert [s['segment'] for s in engine.get_all_segments()] == ['MAIL_VOICE_MESSAGES', 'CLOUD_DISCOUNT_30', 'MAIL_GPT']
+
+    # Новый сегмент с тем же названием не наследует связи
+    engine.add_segment('TEST', None)
+    assert engine.get_users_in_segment('TEST') == []
+
+
+def test_segments_stats_ordering(engine):
+    engine.add_segment('A_FIRST', None)
+    engine.add_segment('Z_LAST', None)
+    engine.add_user_to_segment(1, engine.get_segment_id('Z_LAST'))
+
+    stats = engine.get_segments_stats()
+
+    assert [row['segment'] for row in stats] == ['A_FIRST'] + SEEDED_SEGMENTS + ['Z_LAST']
+    assert segment_counts(engine)['Z_LAST'] == 1
+    assert segment_counts(engine)['A_FIRST'] == 0
+
+
+def test_update_description(engine):
+    engine.update_segment_description('MAIL_GPT', 'Новое описание')
+    assert engine.get_segment('MAIL_GPT') == {'segment': 'MAIL_GPT', 'description': 'Новое описание'}
+
+
+def test_reload_after_flush(engine):
+    engine.add_user('999', 'new@example.com')
+    engine.add_segment('TEST', 'Тестовый сегмент')
+    engine.add_segment('REMOVED', None)
+    segment_id = engine.get_segment_id('TEST')
+    for user_id in (1, 3, 6):
+        engine.add_user_to_segment(user_id, segment_id)
+    engine.add_user_to_segment(2, engine.get_segment_id('REMOVED'))
+    engine.delete_segment('REMOVED')
+    engine.distribute_segment_to_percent(engine.get_segment_id('MAIL_GPT'), 50)
+
+    expected = (
+        engine.get_all_users(),
+        engine.get_all_segments(),
+        engine.get_segments_stats(),
+        engine.get_users_in_segment('TEST'),
+    )
+    engine.close()
+
+    # Состояние должно одинаково читаться обоими движками из database.db
+    for name in ('sqlite', 'memory'):
+        reopened = storage.create_engine(name)
+        reopened.start()
+        try:
+            assert (
+                reopened.get_all_users(),
+                reopened.get_all_segments(),
+                reopened.get_segments_stats(),
+                reopened.get_users_in_segment('TEST'),
+            ) == expected
+        finally:
+            reopened.close()
+
+
+def test_split_segments_is_exclusive(engine):
+    names = ['MAIL_GPT', 'CLOUD_DISCOUNT_30', 'MAIL_VOICE_MESSAGES']
+    segment_ids = [engine.get_segment_id(name) for name in names]
+
+    # Сумма долей во float чуть больше 100, но пользователей не может стать больше
+    counts = engine.split_segments(segment_ids, [99.4, 0.4, 0.2])
+
+    assert counts == [4, 0, 0]
+    assert [engine.count_users_in_segment(segment_id) for segment_id in segment_ids] == counts
+    assert all(len(engine.get_user_segments(user_id)) <= 1 for user_id in range(1, 6))
+
+
+def test_split_segments_stratified(engine):
+    for index in range(95):
+        engine.add_user(f'user{index}', None)
+    engine.add_segment('TEST', None)
+    test_id = engine.get_segment_id('TEST')
+    for user_id in range(1, 41):
+        engine.add_user_to_segment(user_id, test_id)
+    gpt_id = engine.get_segment_id('MAIL_GPT')
+    cloud_id = engine.get_segment_id('CLOUD_DISCOUNT_30')
+
+    counts = engine.split_segments([gpt_id, cloud_id], [50, 30], stratify_segment_id=test_id)
+
+    # Доли считаются отдельно: 40 участников TEST и 60 остальных
+    assert counts == [20 + 30, 12 + 18]
+    members = set(range(1, 41))
+    arms = [
+        {user_id for user_id in range(1, 101) if engine.is_user_in_segment(user_id, segment_id)}
+        for segment_id in (gpt_id, cloud_id)
+    ]
+    assert [len(arm & members) for arm in arms] == [20, 12]
+    assert [len(arm - members) for arm in arms] == [30, 18]
+    assert not arms[0] & arms[1]
+    assert engine.count_users_in_segment(test_id) == 40
+
+
+def test_segments_overlap(engine, monkeypatch):
+    # Маленькие блоки, чтобы проверить разбиение на несколько шагов
+    monkeypatch.setattr(overlap, 'PAIR_BLOCK_SIZE', 3)
+    engine.add_segment('TEST', None)
+    memberships = {
+        'MAIL_GPT': [1, 2, 3],
+        'CLOUD_DISCOUNT_30': [2, 3, 4],
+        'TEST': [3, 5],
+    }
+    for name, user_ids in memberships.items():
+        for user_id in user_ids:
+            engine.add_user_to_segment(user_id, engine.get_segment_id(name))
+
+    result = engine.get_segments_overlap()
+
+    names = result['segments']
+    assert names == ['CLOUD_DISCOUNT_30', 'MAIL_GPT', 'MAIL_VOICE_MESSAGES', 'TEST']
+    expected = [
+        [len(set(memberships.get(a, [])) & set(memberships.get(b, []))) for b in names]
+        for a in names
+    ]
+    assert result['matrix'] == expected
+
+    # Кэш сбрасывается при изменении связей
+    engine.delete_user_in_segment(3, engine.get_segment_id('TEST'))
+    assert engine.get_segments_overlap()['matrix'][3] == [0, 0, 0, 1]
+
+
+def test_sqlite_overlap_cache_sees_external_writes(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, 'DATABASE', str(tmp_path / 'database.db'))
+    engine = storage.SQLiteEngine()
+    engine.start()
+    gpt_id = engine.get_segment_id('MAIL_GPT')
+    assert engine.get_segments_overlap()['matrix'][1][1] == 0
+
+    # Запись мимо движка, как из другого воркера
+    database.add_user_to_segment(1, gpt_id)
+
+    assert engine.get_segments_overlap()['matrix'][1][1] == 1
+
+
+def test_add_user_to_segment_result(engine):
+    gpt_id = engine.get_segment_id('MAIL_GPT')
+
+    assert engine.add_user_to_segment(1, gpt_id) is True
+    assert engine.add_user_to_segment(1, gpt_id) is False
+    assert engine.add_user_to_segment(404, gpt_id) is False
+    assert engine.get_users_in_segment('MAIL_GPT') == ['123']
+
+
+def test_compact_storage(engine):
+    # Осиротевшие связи, оставшиеся со времён без PRAGMA foreign_keys
+    with database.get_db_connection() as connection:
+        connection.execute('PRAGMA foreign_keys = OFF')
+        connection.executemany(
+            'INSERT INTO U_S (user_id, segment_id) VALUES (?, ?)',
+            [(user_id, 99) for user_id in range(1, 6)] + [(404, 1)]
+        )
+        connection.commit()
+
+    report = engine.compact_storage()
+
+    assert report['orphans_removed'] == 6
+    assert report['vacuum'] == 'incremental'
+    assert report['bytes_reclaimed'] >= 0
+    assert engine.compact_storage()['orphans_removed'] == 0
+
+
+def test_compact_storage_converts_only_on_request(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, 'DATABASE', str(tmp_path / 'database.db'))
+    with database.get_db_connection() as connection:
+        connection.execute('CREATE TABLE Legacy (id INTEGER PRIMARY KEY)')
+        connection.commit()
+    database.init_db()
+
+    assert database.compact_storage()['vacuum'] == 'skipped'
+    assert database.compact_storage(convert=True)['vacuum'] == 'full'
+    assert database.compact_storage()['vacuum'] == 'incremental'
+
+
+def test_membership_version_bumps_once_per_write(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, 'DATABASE', str(tmp_path / 'database.db'))
+    database.init_db()
+    segment_ids = [database.get_segment_id(name) for name in SEEDED_SEGMENTS]
+
+    version = database.get_membership_version()
+    database.split_segments(segment_ids, [40, 40, 20])
+    assert database.get_membership_version() == version + 1
+
+    # Без изменений версия не растёт
+    database.delete_user_in_segment(404, segment_ids[0])
+    database.update_segment_description('MAIL_GPT', 'Новое описание')
+    assert database.get_membership_version() == version + 1
+
+
+def test_delete_segment_is_chunked(engine, monkeypatch):
+    monkeypatch.setattr(database, 'DELETE_CHUNK_SIZE', 2)
+    chunks = []
+    delete_links = database._delete_segment_links
+
+    def counting_delete_links(connection, segment_id):
+        removed = delete_links(connection, segment_id)
+        chunks.append(removed)
+        return removed
+
+    monkeypatch.setattr(database, '_delete_segment_links', counting_delete_links)
+    segment_id = engine.get_segment_id('MAIL_GPT')
+    for user_id in range(1, 6):
+        engine.add_user_to_segment(user_id, segment_id)
+
+    engine.delete_segment('MAIL_GPT')
+    if hasattr(engine, 'flush'):
+        engine.flush()
+
+    assert chunks == [5]
+    with database.get_db_connection() as connection:
+        assert connection.execute('SELECT COUNT(*) FROM U_S').fetchone()[0] == 0
+        assert connection.execute("SELECT COUNT(*) FROM Segments WHERE segment = 'MAIL_GPT'").fetchone()[0] == 0
+
+
+def test_memory_snapshot_copies_without_rewriting(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, 'DATABASE', str(tmp_path / 'database.db'))
+    engine = storage.create_engine('memory')
+    engine.start()
+    try:
+        engine.add_user_to_segment(1, engine.get_segment_id('MAIL_GPT'))
+        # Запись мимо движка не должна пропасть из рабочей БД
+        database.add_user('777', 'outside@example.com')
+
+        path = engine.snapshot()
+
+        assert path == str(tmp_path / 'database.db.snapshot')
+        assert database.count_users() == 6
+    finally:
+        engine.close()
+
+    monkeypatch.setattr(database, 'DATABASE', path)
+    assert database.get_users_in_segment('MAIL_GPT') == ['123']